@@ -0,0 +1,88 @@
+import asyncio
+import io
+import json
+import os
+from llm_client import get_client
+from v4_handoffs import (
+    DEMO_QUERIES,
+    build_request,
+    detect_intent,
+    parse_output,
+    print_result
+)
+
+# Runs the v4 demo queries through the OpenAI Batch API (half the cost of live calls,
+# results within the completion window). Use v4_handoffs.py directly for interactive latency.
+
+POLL_INTERVAL = float(os.getenv("BATCH_POLL_SECONDS", "30"))
+ENDPOINT = "/v1/chat/completions"
+
+
+def build_batch_file(queries) -> bytes:
+    lines = []
+    for i, query in enumerate(queries):
+        task_type, _ = detect_intent(query)
+        lines.append(json.dumps({
+            "custom_id": f"q{i}",
+            "method": "POST",
+            "url": ENDPOINT,
+            "body": build_request(task_type, query),
+        }, separators=(",", ":")))
+    return "\n".join(lines).encode()
+
+
+async def read_jsonl(file_id):
+    if not file_id:
+        return []
+    content = await get_client().files.content(file_id)
+    return [json.loads(line) for line in content.text.splitlines() if line.strip()]
+
+
+async def run_batch(queries):
+    batch_file = await get_client().files.create(
+        file=("queries.jsonl", io.BytesIO(build_batch_file(queries))),
+        purpose="batch"
+    )
+    batch = await get_client().batches.create(
+        input_file_id=batch_file.id,
+        endpoint=ENDPOINT,
+        completion_window="24h"
+    )
+    print(f"Submitted batch {batch.id}")
+
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        await asyncio.sleep(POLL_INTERVAL)
+        batch = await get_client().batches.retrieve(batch.id)
+        print(f"Batch status: {batch.status}")
+
+    if batch.status != "completed":
+        raise RuntimeError(f"Batch {batch.id} ended with status {batch.status}")
+
+    # Successful requests land in the output file, failed ones in the error file;
+    # either may be missing, and lines are not guaranteed to be in input order
+    raw_by_id = {}
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        for item in await read_jsonl(file_id):
+            response = item.get("response") or {}
+            if response.get("status_code") == 200:
+                raw_by_id[item["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+            else:
+                print(f"❌ {item['custom_id']} failed:", item.get("error") or response.get("body") or response)
+    return raw_by_id
+
+
+async def main():
+    queries = DEMO_QUERIES
+    try:
+        raw_by_id = await run_batch(queries)
+    finally:
+        await get_client().close()
+
+    for i, query in enumerate(queries):
+        raw = raw_by_id.get(f"q{i}")
+        _, output_model = detect_intent(query)
+        result = parse_output(raw, output_model) if raw is not None else None
+        print_result(query, result)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,106 @@
+import hashlib
+import re
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+from llm_client import get_client
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+SIMILARITY_THRESHOLD = 0.95
+MAX_ENTRIES = 256
+
+_NUMBER_RE = re.compile(r"\d+(?:[.,]\d+)*")
+
+
+def _normalize(query: str) -> str:
+    return " ".join(query.lower().split())
+
+
+def _scope(task_type: str, context) -> str:
+    # Only the preferences that end up in the prompt decide whether an answer can be reused
+    return (
+        f"{task_type}|{context.budget_level}|"
+        f"{','.join(sorted(context.preferred_airlines))}|{','.join(sorted(context.hotel_amenities))}"
+    )
+
+
+@dataclass
+class CacheLookup:
+    """Result of a cache lookup, handed back to put() so nothing is kept for misses."""
+    key: str
+    scope: str
+    normalized: str
+    raw_json: Optional[str] = None
+    vector: Optional[np.ndarray] = None
+
+    @property
+    def exact(self) -> bool:
+        return self.raw_json is not None
+
+
+class SemanticCache:
+    """In-memory cache of raw JSON responses keyed by intent, query and user preferences.
+
+    lookup() finds exact matches by hash. match() embeds the query and compares it against
+    cached queries with the same scope; a cosine similarity above the threshold counts as
+    a hit, as long as both queries mention the same numbers (budgets, days, prices).
+    """
+
+    def __init__(self, max_entries: int = MAX_ENTRIES, threshold: float = SIMILARITY_THRESHOLD):
+        self._max_entries = max_entries
+        self._threshold = threshold
+        # key -> (scope, numbers, embedding, raw_json), oldest first
+        self._entries: OrderedDict = OrderedDict()
+
+    async def _embed(self, normalized: str) -> Optional[np.ndarray]:
+        try:
+            response = await get_client().embeddings.create(model=EMBEDDING_MODEL, input=normalized)
+        except Exception as e:
+            print("Cache embedding failed:", e)
+            return None
+        # OpenAI embeddings are unit length, so a dot product is the cosine similarity
+        return np.asarray(response.data[0].embedding, dtype=np.float32)
+
+    def lookup(self, task_type: str, query: str, context) -> CacheLookup:
+        scope = _scope(task_type, context)
+        normalized = _normalize(query)
+        key = hashlib.blake2b(f"{scope}|{normalized}".encode()).hexdigest()
+        lookup = CacheLookup(key=key, scope=scope, normalized=normalized)
+
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            lookup.raw_json = self._entries[key][3]
+        return lookup
+
+    async def match(self, lookup: CacheLookup) -> Optional[str]:
+        # Embeds the query (kept on the lookup for put) and returns the closest same-scope answer
+        lookup.vector = await self._embed(lookup.normalized)
+        if lookup.vector is None:
+            return None
+
+        numbers = _NUMBER_RE.findall(lookup.normalized)
+        candidates = [
+            (k, entry) for k, entry in self._entries.items()
+            if entry[0] == lookup.scope and entry[1] == numbers and entry[2] is not None
+        ]
+        if not candidates:
+            return None
+
+        matrix = np.stack([entry[2] for _, entry in candidates])
+        scores = matrix @ lookup.vector
+        best = int(np.argmax(scores))
+        if scores[best] < self._threshold:
+            return None
+
+        hit_key = candidates[best][0]
+        self._entries.move_to_end(hit_key)
+        return self._entries[hit_key][3]
+
+    def put(self, lookup: CacheLookup, raw_json: str) -> None:
+        numbers = _NUMBER_RE.findall(lookup.normalized)
+        self._entries[lookup.key] = (lookup.scope, numbers, lookup.vector, raw_json)
+        self._entries.move_to_end(lookup.key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
@@ -0,0 +1,24 @@
+import functools
+import importlib.util
+import os
+import httpx
+from openai import AsyncOpenAI
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+
+def _shared_httpx() -> httpx.AsyncClient:
+    # Pooled HTTP transport so concurrent requests reuse keep-alive connections (HTTP/2 when h2 is installed)
+    return httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=50),
+        timeout=30.0,
+        http2=importlib.util.find_spec("h2") is not None,
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def get_client() -> AsyncOpenAI:
+    # One client per process, so every agent version shares the same connection pool
+    return AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=_shared_httpx())
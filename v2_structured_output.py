@@ -3,16 +3,16 @@ import os
 import re
 from typing import List
 from pydantic import BaseModel, Field, ValidationError
-from openai import AsyncOpenAI
 from dotenv import load_dotenv
+from llm_client import get_client
 
 # Load .env vars
 load_dotenv()
-api_key = os.getenv("OPENAI_API_KEY")
 model = "gpt-4o-mini"
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "5"))
 
-# Setup OpenAI client
-client = AsyncOpenAI(api_key=api_key)
+# Matches markdown code fences like ```json ... ``` around the model output
+_FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```\s*$", re.IGNORECASE)
 
 # --- Structured Output Class ---
 class TravelPlan(BaseModel):
@@ -40,45 +40,60 @@ User query:
 "{query}"
 """
 
-# --- Async Runner ---
-async def main():
-    queries = [
-        "I'm planning a trip to Miami for 5 days with a budget of $2000. What should I do there?",
-        "I want to visit Tokyo for a week with a budget of $3000. What activities do you recommend?"
-    ]
-
-    for query in queries:
-        print("\n" + "="*60)
-        print(f"QUERY: {query}")
-
+# --- Per-Query Worker ---
+async def process(query: str, sem: asyncio.Semaphore):
+    async with sem:
         prompt = build_prompt(query)
-        response = await client.chat.completions.create(
+        response = await get_client().chat.completions.create(
             model=model,
             messages=[{"role": "user", "content": prompt}],
             temperature=0.7,
         )
 
-        raw = response.choices[0].message.content.strip()
+    raw = response.choices[0].message.content.strip()
+
+    cleaned = _FENCE_RE.sub("", raw).strip()
 
-        # Remove markdown code fences like ```json ... ```
-        cleaned = re.sub(r"^```json\n?|```$", "", raw.strip(), flags=re.IGNORECASE).strip()
+    print("\n" + "="*60)
+    print(f"QUERY: {query}")
 
-        try:
-            travel_plan = TravelPlan.model_validate_json(cleaned)
+    try:
+        travel_plan = TravelPlan.model_validate_json(cleaned)
 
-            # --- Pretty Output ---
-            print(f"\n🌍 TRAVEL PLAN FOR {travel_plan.destination.upper()} 🌍")
-            print(f"Duration: {travel_plan.duration_days} days")
-            print(f"Budget: ${travel_plan.budget}")
-            print("\n🎯 RECOMMENDED ACTIVITIES:")
-            for i, activity in enumerate(travel_plan.activities, 1):
-                print(f"  {i}. {activity}")
-            print(f"\n📝 NOTES: {travel_plan.notes}")
+        # --- Pretty Output ---
+        print(f"\n🌍 TRAVEL PLAN FOR {travel_plan.destination.upper()} 🌍")
+        print(f"Duration: {travel_plan.duration_days} days")
+        print(f"Budget: ${travel_plan.budget}")
+        print("\n🎯 RECOMMENDED ACTIVITIES:")
+        for i, activity in enumerate(travel_plan.activities, 1):
+            print(f"  {i}. {activity}")
+        print(f"\n📝 NOTES: {travel_plan.notes}")
+
+    except ValidationError as e:
+        print("\n❌ Error parsing structured output:")
+        print(e)
+        print("\nRaw Output:\n", raw)
+
+# --- Async Runner ---
+async def main():
+    queries = [
+        "I'm planning a trip to Miami for 5 days with a budget of $2000. What should I do there?",
+        "I want to visit Tokyo for a week with a budget of $3000. What activities do you recommend?"
+    ]
 
-        except ValidationError as e:
-            print("\n❌ Error parsing structured output:")
-            print(e)
-            print("\nRaw Output:\n", raw)
+    # Queries are independent, so run them concurrently (capped to respect rate limits)
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    try:
+        results = await asyncio.gather(*[process(query, sem) for query in queries], return_exceptions=True)
+    finally:
+        await get_client().close()
+
+    # A failed request shouldn't abort the others; report it alongside their output
+    for query, result in zip(queries, results):
+        if isinstance(result, Exception):
+            print("\n" + "="*60)
+            print(f"QUERY: {query}")
+            print(f"\n❌ Request failed: {result}")
 
 if __name__ == "__main__":
     asyncio.run(main())
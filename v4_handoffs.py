@@ -1,18 +1,15 @@
 import asyncio
-import json
 import os
+import re
 from typing import List, Optional
-from pydantic import BaseModel, Field, ValidationError
-from openai import AsyncOpenAI
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
 from dotenv import load_dotenv
+from llm_client import get_client
 
 # Load environment variables
 load_dotenv()
-api_key = os.getenv("OPENAI_API_KEY")
 model = os.getenv('MODEL_CHOICE', 'gpt-4o-mini')
-
-# Setup OpenAI client
-client = AsyncOpenAI(api_key=api_key)
+MAX_CONCURRENCY = int(os.getenv('MAX_CONCURRENCY', '5'))
 
 # --- Structured Output Models ---
 
@@ -38,118 +35,151 @@ class TravelPlan(BaseModel):
     activities: List[str]
     notes: str
 
+# Validators are built once and reused for every response
+_ADAPTERS = {cls: TypeAdapter(cls) for cls in (FlightRecommendation, HotelRecommendation, TravelPlan)}
+
 # --- Prompt Builder ---
 
+def _response_format(model_cls) -> dict:
+    # Strict structured outputs require every property listed as required and no extra keys
+    schema = model_cls.model_json_schema()
+    schema["additionalProperties"] = False
+    schema["required"] = list(schema["properties"])
+    for prop in schema["properties"].values():
+        prop.pop("default", None)
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": model_cls.__name__, "schema": schema, "strict": True},
+    }
+
+# Schemas never change at runtime, so build the response formats once at import
+_RESPONSE_FORMATS = {
+    "flight": _response_format(FlightRecommendation),
+    "hotel": _response_format(HotelRecommendation),
+    "plan": _response_format(TravelPlan),
+}
+
 def build_prompt(task_type: str, query: str) -> str:
     if task_type == "flight":
-        schema = json.dumps(FlightRecommendation.model_json_schema(), indent=2)
         return f"""
 You are a flight booking assistant.
-Use the following query to return a flight recommendation in this JSON format:
-{schema}
-
-Only return valid JSON.
+Use the following query to return a flight recommendation.
 User: {query}
 """
     elif task_type == "hotel":
-        schema = json.dumps(HotelRecommendation.model_json_schema(), indent=2)
         return f"""
 You are a hotel booking assistant.
-Use the following query to return a hotel recommendation in this JSON format:
-{schema}
-
-Only return valid JSON.
+Use the following query to return a hotel recommendation.
 User: {query}
 """
     else:
-        schema = json.dumps(TravelPlan.model_json_schema(), indent=2)
         return f"""
 You are a travel planner.
-Use the following query to return a travel plan in this JSON format:
-{schema}
-
-Only return valid JSON.
+Use the following query to return a travel plan.
 User: {query}
 """
 
 # --- Main Logic ---
 
-async def handle_query(query: str):
-    # Heuristics to detect intent
-    if "flight" in query.lower():
-        task_type = "flight"
-        output_model = FlightRecommendation
-    elif "hotel" in query.lower():
-        task_type = "hotel"
-        output_model = HotelRecommendation
-    else:
-        task_type = "plan"
-        output_model = TravelPlan
-
-    prompt = build_prompt(task_type, query)
+# Keyword -> output model; anything unmatched is treated as a general travel plan
+_INTENT_RE = re.compile(r"\b(flight|hotel)s?\b", re.IGNORECASE)
+_INTENT_MODELS = {"flight": FlightRecommendation, "hotel": HotelRecommendation, "plan": TravelPlan}
 
-    response = await client.chat.completions.create(
-        model=model,
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.7
-    )
-
-    raw = response.choices[0].message.content.strip()
+def detect_intent(query: str):
+    # Heuristics to detect intent
+    match = _INTENT_RE.search(query)
+    task_type = match.group(1).lower() if match else "plan"
+    return task_type, _INTENT_MODELS[task_type]
 
+def parse_output(raw: str, output_model):
     try:
-        parsed = output_model.model_validate_json(raw)
-        return parsed
+        return _ADAPTERS[output_model].validate_json(raw)
     except ValidationError as e:
         print("\n❌ Error parsing structured output:")
         print(e)
         print("\nRaw Output:\n", raw)
         return None
 
+def build_request(task_type: str, query: str) -> dict:
+    return {
+        "model": model,
+        "messages": [{"role": "user", "content": build_prompt(task_type, query)}],
+        "temperature": 0.7,
+        "response_format": _RESPONSE_FORMATS[task_type],
+    }
+
+async def handle_query(query: str):
+    task_type, output_model = detect_intent(query)
+    response = await get_client().chat.completions.create(**build_request(task_type, query))
+
+    raw = response.choices[0].message.content
+    return parse_output(raw, output_model)
+
 # --- Runner ---
 
+DEMO_QUERIES = [
+    "I need a flight from New York to Chicago tomorrow",
+    "Find me a hotel in Paris with a pool for under $300 per night",
+    "Plan a trip to Miami for 5 days with a $2000 budget"
+]
+
+def print_result(query: str, result):
+    print("\n" + "="*60)
+    print(f"QUERY: {query}")
+
+    if isinstance(result, FlightRecommendation):
+        print("\n✈️ FLIGHT RECOMMENDATION ✈️")
+        print(f"Airline: {result.airline}")
+        print(f"Departure: {result.departure_time}")
+        print(f"Arrival: {result.arrival_time}")
+        print(f"Price: ${result.price}")
+        print(f"Direct Flight: {'Yes' if result.direct_flight else 'No'}")
+        print(f"Why: {result.recommendation_reason}")
+
+    elif isinstance(result, HotelRecommendation):
+        print("\n🏨 HOTEL RECOMMENDATION 🏨")
+        print(f"Name: {result.name}")
+        print(f"Location: {result.location}")
+        print(f"Price per night: ${result.price_per_night}")
+        print("Amenities:")
+        for i, amenity in enumerate(result.amenities, 1):
+            print(f"  {i}. {amenity}")
+        print(f"Why: {result.recommendation_reason}")
+
+    elif isinstance(result, TravelPlan):
+        print(f"\n🌍 TRAVEL PLAN FOR {result.destination.upper()} 🌍")
+        print(f"Duration: {result.duration_days} days")
+        print(f"Budget: ${result.budget}")
+        print("Activities:")
+        for i, act in enumerate(result.activities, 1):
+            print(f"  {i}. {act}")
+        print(f"Notes: {result.notes}")
+
+    elif isinstance(result, Exception):
+        print(f"\n❌ Request failed: {result}")
+
+    else:
+        print("🤷‍♂️ Could not parse output")
+
+
 async def main():
-    queries = [
-        "I need a flight from New York to Chicago tomorrow",
-        "Find me a hotel in Paris with a pool for under $300 per night",
-        "Plan a trip to Miami for 5 days with a $2000 budget"
-    ]
-
-    for query in queries:
-        print("\n" + "="*60)
-        print(f"QUERY: {query}")
-
-        result = await handle_query(query)
-
-        if isinstance(result, FlightRecommendation):
-            print("\n✈️ FLIGHT RECOMMENDATION ✈️")
-            print(f"Airline: {result.airline}")
-            print(f"Departure: {result.departure_time}")
-            print(f"Arrival: {result.arrival_time}")
-            print(f"Price: ${result.price}")
-            print(f"Direct Flight: {'Yes' if result.direct_flight else 'No'}")
-            print(f"Why: {result.recommendation_reason}")
-
-        elif isinstance(result, HotelRecommendation):
-            print("\n🏨 HOTEL RECOMMENDATION 🏨")
-            print(f"Name: {result.name}")
-            print(f"Location: {result.location}")
-            print(f"Price per night: ${result.price_per_night}")
-            print("Amenities:")
-            for i, amenity in enumerate(result.amenities, 1):
-                print(f"  {i}. {amenity}")
-            print(f"Why: {result.recommendation_reason}")
-
-        elif isinstance(result, TravelPlan):
-            print(f"\n🌍 TRAVEL PLAN FOR {result.destination.upper()} 🌍")
-            print(f"Duration: {result.duration_days} days")
-            print(f"Budget: ${result.budget}")
-            print("Activities:")
-            for i, act in enumerate(result.activities, 1):
-                print(f"  {i}. {act}")
-            print(f"Notes: {result.notes}")
-
-        else:
-            print("🤷‍♂️ Could not parse output")
+    queries = DEMO_QUERIES
+
+    # Queries are independent, so run them concurrently (capped to respect rate limits)
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+
+    async def bounded(query: str):
+        async with sem:
+            return await handle_query(query)
+
+    tasks = [bounded(query) for query in queries]
+    try:
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        await get_client().close()
+
+    for query, result in zip(queries, results):
+        print_result(query, result)
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -1,16 +1,24 @@
 import streamlit as st
 import asyncio
+import itertools
+import re
+import threading
 import uuid
+from dataclasses import replace
+from html import escape
 from datetime import datetime
 from typing import List
 from v5_guardrails_and_context import (
-    handle_query,
+    handle_query_stream,
     UserContext,
     TravelPlan,
     FlightRecommendation,
     HotelRecommendation
 )
 
+BOT_AVATAR_URL = "https://api.dicebear.com/7.x/bottts/svg?seed=travel-agent"
+_BLANK_LINES_RE = re.compile(r"\n\s*\n")
+
 # Page config
 st.set_page_config(
     page_title="Travel Planner Assistant",
@@ -84,17 +92,18 @@ if "user_input_value" not in st.session_state:
 
 # Format agent responses
 def format_agent_response(response_dict):
+    # LLM output is rendered with unsafe_allow_html, so every field is escaped
     if not isinstance(response_dict, dict):
         if hasattr(response_dict, "model_dump"):
             response_dict = {"result": response_dict.model_dump()}
         else:
-            return str(response_dict)
+            return escape(str(response_dict))
 
     if response_dict.get("type") == "guardrail":
         return f"""
         <div style='color:#b30000;font-weight:bold;'>⚠️ GUARDRAIL TRIGGERED</div>
-        <p><strong>Reason:</strong> {response_dict.get("reasoning")}</p>
-        <p><strong>Suggested Budget:</strong> ${response_dict.get("suggested_budget")}</p>
+        <p><strong>Reason:</strong> {escape(str(response_dict.get("reasoning")))}</p>
+        <p><strong>Suggested Budget:</strong> ${escape(str(response_dict.get("suggested_budget")))}</p>
         """
 
     result = response_dict.get("result")
@@ -102,49 +111,70 @@ def format_agent_response(response_dict):
         result = result.model_dump()
 
     if isinstance(result, dict):
+        def field(key):
+            return escape(str(result.get(key)))
+
         if "destination" in result:
-            html = f"""
-            <h3>Travel Plan for {result.get('destination')}</h3>
-            <p><strong>Duration:</strong> {result.get('duration_days')} days</p>
-            <p><strong>Budget:</strong> ${result.get('budget')}</p>
+            activities = "".join(f"<li>{escape(str(a))}</li>" for a in result.get("activities", []))
+            return f"""
+            <h3>Travel Plan for {field('destination')}</h3>
+            <p><strong>Duration:</strong> {field('duration_days')} days</p>
+            <p><strong>Budget:</strong> ${field('budget')}</p>
             <h4>Recommended Activities:</h4>
-            <ul>"""
-            for activity in result.get("activities", []):
-                html += f"<li>{activity}</li>"
-            html += f"</ul><p><strong>Notes:</strong> {result.get('notes')}</p>"
-            return html
+            <ul>{activities}</ul><p><strong>Notes:</strong> {field('notes')}</p>"""
 
         elif "airline" in result:
             return f"""
             <h3>Flight Recommendation</h3>
-            <p><strong>Airline:</strong> {result.get('airline')}</p>
-            <p><strong>Departure:</strong> {result.get('departure_time')}</p>
-            <p><strong>Arrival:</strong> {result.get('arrival_time')}</p>
-            <p><strong>Price:</strong> ${result.get('price')}</p>
+            <p><strong>Airline:</strong> {field('airline')}</p>
+            <p><strong>Departure:</strong> {field('departure_time')}</p>
+            <p><strong>Arrival:</strong> {field('arrival_time')}</p>
+            <p><strong>Price:</strong> ${field('price')}</p>
             <p><strong>Direct Flight:</strong> {'Yes' if result.get('direct_flight') else 'No'}</p>
-            <p><strong>Why this flight:</strong> {result.get('recommendation_reason')}</p>
+            <p><strong>Why this flight:</strong> {field('recommendation_reason')}</p>
             """
 
         elif "name" in result and "amenities" in result:
-            html = f"""
-            <h3>Hotel Recommendation: {result.get('name')}</h3>
-            <p><strong>Location:</strong> {result.get('location')}</p>
-            <p><strong>Price per night:</strong> ${result.get('price_per_night')}</p>
+            amenities = "".join(f"<li>{escape(str(a))}</li>" for a in result.get("amenities", []))
+            return f"""
+            <h3>Hotel Recommendation: {field('name')}</h3>
+            <p><strong>Location:</strong> {field('location')}</p>
+            <p><strong>Price per night:</strong> ${field('price_per_night')}</p>
             <h4>Amenities:</h4>
-            <ul>"""
-            for amenity in result.get("amenities", []):
-                html += f"<li>{amenity}</li>"
-            html += f"</ul><p><strong>Why this hotel:</strong> {result.get('recommendation_reason')}</p>"
-            return html
+            <ul>{amenities}</ul><p><strong>Why this hotel:</strong> {field('recommendation_reason')}</p>"""
 
-    return str(result)
+    return escape(str(result))
+
+# One event loop for the whole app so the HTTP connection pool survives across reruns
+@st.cache_resource
+def get_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+# Bridge the async token stream to the sync generator st.write_stream expects
+def stream_adapter(agen, sink: dict):
+    loop = get_loop()
+    try:
+        while True:
+            try:
+                item = asyncio.run_coroutine_threadsafe(agen.__anext__(), loop).result()
+            except StopAsyncIteration:
+                break
+            if isinstance(item, str):
+                yield item
+            else:
+                # The last item is the parsed result, kept for the structured render
+                sink["result"] = item
+    finally:
+        asyncio.run_coroutine_threadsafe(agen.aclose(), loop).result()
 
 # Handle user input
 def handle_user_message(user_input: str):
     timestamp = datetime.now().strftime("%I:%M %p")
     st.session_state.chat_history.append({
         "role": "user",
-        "content": user_input,
+        "content": escape(user_input),
         "timestamp": timestamp
     })
     st.session_state.processing_message = user_input
@@ -174,9 +204,12 @@ with st.sidebar:
     )
 
     if st.button("Save Preferences"):
-        st.session_state.user_context.preferred_airlines = preferred_airlines
-        st.session_state.user_context.hotel_amenities = preferred_amenities
-        st.session_state.user_context.budget_level = budget_level
+        st.session_state.user_context = replace(
+            st.session_state.user_context,
+            preferred_airlines=preferred_airlines,
+            hotel_amenities=preferred_amenities,
+            budget_level=budget_level
+        )
         st.success("Preferences saved!")
 
     if st.button("Start New Conversation"):
@@ -199,59 +232,51 @@ if st.session_state.processing_message:
     query = st.session_state.processing_message
     st.session_state.processing_message = None
 
-    with st.spinner("Thinking..."):
-        try:
-            print("🧠 DEBUG - UserContext:", st.session_state.user_context)
-            result = asyncio.run(handle_query(query, st.session_state.user_context))
-            response_content = format_agent_response(result)
-            print("🧪 DEBUG - Formatted HTML:", response_content)
-        except Exception as e:
-            response_content = f"\u274c Error: {str(e)}"
-
-        st.session_state.chat_history.append({
-            "role": "assistant",
-            "content": response_content,
-            "timestamp": datetime.now().strftime("%I:%M %p")
-        })
-
-# Render chat history
+    # Show tokens as they arrive, then swap in the formatted answer from chat history
+    stream_placeholder = st.empty()
+    try:
+        print("🧠 DEBUG - UserContext:", st.session_state.user_context)
+        sink = {}
+        with stream_placeholder.container():
+            tokens = stream_adapter(handle_query_stream(query, st.session_state.user_context), sink)
+            # Guardrail and cache work happen before the first token, so keep the spinner until then
+            with st.spinner("Thinking..."):
+                first_token = next(tokens, None)
+            if first_token is not None:
+                st.write_stream(itertools.chain([first_token], tokens))
+        response_content = format_agent_response(sink.get("result"))
+        print("🧪 DEBUG - Formatted HTML:", response_content)
+    except Exception as e:
+        response_content = f"\u274c Error: {escape(str(e))}"
+    stream_placeholder.empty()
+
+    st.session_state.chat_history.append({
+        "role": "assistant",
+        "content": response_content,
+        "timestamp": datetime.now().strftime("%I:%M %p")
+    })
+
+# Render chat history in a single markdown call
+user_avatar_url = f"https://api.dicebear.com/7.x/avataaars/svg?seed={st.session_state.user_context.user_id}"
+html_parts = []
 for message in st.session_state.chat_history:
     role_class = "user" if message["role"] == "user" else "assistant"
-    avatar_url = (
-        f"https://api.dicebear.com/7.x/avataaars/svg?seed={st.session_state.user_context.user_id}"
-        if role_class == "user"
-        else "https://api.dicebear.com/7.x/bottts/svg?seed=travel-agent"
-    )
+    avatar_url = user_avatar_url if role_class == "user" else BOT_AVATAR_URL
 
-    if role_class == "user":
-        st.markdown(f"""
-        <div class="chat-message user">
-            <div class="content">
-                <img src="{avatar_url}" class="avatar" />
-                <div class="message">
-                    {message["content"]}
-                    <div class="timestamp">{message["timestamp"]}</div>
-                </div>
-            </div>
-        </div>
-        """, unsafe_allow_html=True)
-    else:
-        st.markdown(f"""
-        <div class="chat-message assistant">
-            <div class="content">
-                <img src="{avatar_url}" class="avatar" />
-                <div class="message">
-        """, unsafe_allow_html=True)
-
-        # 👇 Properly rendered assistant HTML output, wrapped safely
-        st.markdown(message["content"], unsafe_allow_html=True)
-
-        st.markdown(f"""
-                    <div class="timestamp">{message["timestamp"]}</div>
-                </div>
-            </div>
+    # A blank line ends a markdown HTML block, so collapse any inside the content
+    content = _BLANK_LINES_RE.sub("\n", message["content"].strip())
+    html_parts.append(f"""<div class="chat-message {role_class}">
+    <div class="content">
+        <img src="{avatar_url}" class="avatar" />
+        <div class="message">
+            {content}
+            <div class="timestamp">{message["timestamp"]}</div>
         </div>
-        """, unsafe_allow_html=True)
+    </div>
+</div>""")
+
+if html_parts:
+    st.markdown("\n".join(html_parts), unsafe_allow_html=True)
 
 # Footer
 st.markdown("---")